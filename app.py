@@ -2,13 +2,30 @@ from flask import Flask, request, jsonify, send_from_directory
 import os
 import numpy as np # For librosa
 import requests # For downloading from URL
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import http.cookiejar # To stop the shared session from persisting cookies between users
 from werkzeug.utils import secure_filename # For uploaded filenames
 import uuid # For unique filenames from URLs
 import re # For parsing Content-Disposition if needed, though might not use initially
+import collections # For the LRU result cache
+import threading # Guards the result cache across request threads; also feeds the ffmpeg decoder
+import shutil # For locating ffmpeg and copying downloads
+import subprocess # For streaming URL audio through ffmpeg
+import hashlib # For content-addressed MIDI files
+import functools # For memoizing chord parsing
+import time # For URL cache expiry
+import concurrent.futures # Bounded pool for CPU-heavy analysis
 
-# --- Library Availability Flags ---
+# Persist numba's JIT artifacts (librosa's kernels and ours) across restarts; must be set before numba is imported
+os.environ.setdefault('NUMBA_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.numba_cache'))
+
+# --- Library / Tool Availability Flags ---
 LIBROSA_AVAILABLE = False
 PRETTY_MIDI_AVAILABLE = False
+MIDO_AVAILABLE = False
+NUMBA_AVAILABLE = False
+SOUNDFILE_AVAILABLE = False
 app_log_extra = ""
 
 try:
@@ -25,6 +42,38 @@ try:
 except ImportError:
     app_log_extra += "(pretty_midi not available)"
 
+try:
+    import mido # Installed with pretty_midi; used to write MIDI directly
+    MIDO_AVAILABLE = True
+    app_log_extra += " (mido available)"
+except ImportError:
+    app_log_extra += " (mido not available)"
+MIDI_AVAILABLE = MIDO_AVAILABLE or PRETTY_MIDI_AVAILABLE
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+    app_log_extra += " (numba available)"
+except ImportError:
+    app_log_extra += " (numba not available)"
+
+try:
+    import soundfile
+    SOUNDFILE_AVAILABLE = True
+    app_log_extra += " (soundfile available)"
+except ImportError:
+    app_log_extra += " (soundfile not available)"
+
+try:
+    import soxr # noqa: F401 -- only probed; librosa calls it when res_type is a soxr_* mode
+    RESAMPLE_TYPE = 'soxr_qq' # Quick-quality soxr is ample for 12-bin chroma and much faster than librosa's default filters
+except ImportError:
+    RESAMPLE_TYPE = 'polyphase' # scipy-backed, always available alongside librosa
+app_log_extra += f" (resampler: {RESAMPLE_TYPE})"
+
+FFMPEG_PATH = shutil.which('ffmpeg')
+app_log_extra += " (ffmpeg available)" if FFMPEG_PATH else " (ffmpeg not available)"
+
 
 app = Flask(__name__)
 app.logger.info(f"Starting app with library status: {app_log_extra.strip()}")
@@ -35,79 +84,372 @@ def serve_index():
 
 TEMP_AUDIO_DIR = 'temp_audio'
 TEMP_MIDI_DIR = 'static/midi'
+CHROMA_CACHE_DIR = 'cache_features'
+for _dir in (TEMP_AUDIO_DIR, TEMP_MIDI_DIR, CHROMA_CACHE_DIR): os.makedirs(_dir, exist_ok=True) # Once per process, not per request
+ANALYSIS_SAMPLE_RATE = 11025 # Keeps all harmonic content the 12-bin chroma needs while halving the samples vs 22050
+# ~0.093 s per chroma frame at 11025 Hz: a 2 s segment is int(2 * 11025 / 1024) = 21 frames = 1.95 s (2048 would give
+# 10 frames = 1.86 s). Still 2x coarser than 512 at this rate, and a multiple of 64 as the CQT requires.
+ANALYSIS_HOP_LENGTH = 1024
+# Shared HTTP session: repeat downloads from the same host reuse pooled TCP/TLS connections
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.headers['Accept-Encoding'] = 'identity' # Audio is already compressed; don't pay for gzip on top
+# The session is shared by every user: never store Set-Cookie, or one user's cookies would be replayed on another's download
+HTTP_SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+_http_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.2))
+HTTP_SESSION.mount('https://', _http_adapter); HTTP_SESSION.mount('http://', _http_adapter)
+# Container extension by Content-Type, so downloads are decoded as-is instead of being mislabelled .mp3
+AUDIO_CONTENT_TYPE_EXTS = {'audio/mpeg': '.mp3', 'audio/mp3': '.mp3', 'audio/mp4': '.m4a', 'audio/x-m4a': '.m4a', 'audio/aac': '.aac', 'audio/ogg': '.ogg', 'audio/opus': '.opus', 'audio/webm': '.webm', 'video/webm': '.webm', 'audio/wav': '.wav', 'audio/x-wav': '.wav', 'audio/flac': '.flac', 'video/mp4': '.mp4'}
+# Containers that are only reliably decodable from a seekable file, never streamed through ffmpeg's pipe input
+SEEKABLE_ONLY_EXTS = {'.m4a', '.mp4', '.m4b', '.mov', '.3gp'}
+SEEKABLE_ONLY_CONTENT_TYPES = {'audio/mp4', 'audio/x-m4a', 'video/mp4', 'video/quicktime', 'audio/3gpp', 'video/3gpp'}
+
+# --- Analysis Result Cache (audio_url -> (chords, midi_path), LRU) ---
+# Remote audio can change behind a URL, so every URL-keyed cache (here and the on-disk chroma one) expires
+URL_CACHE_MAX_AGE_S = 24 * 60 * 60
+RESULT_CACHE_MAX = 256
+_result_cache = collections.OrderedDict()
+_result_cache_lock = threading.Lock()
+
+def get_cached_result(key):
+    with _result_cache_lock:
+        entry = _result_cache.get(key)
+        if entry is None: return None
+        chords, midi_path, stored_at = entry
+        if time.time() - stored_at > URL_CACHE_MAX_AGE_S or not os.path.exists(midi_path): # Expired, or MIDI removed from disk
+            del _result_cache[key]; return None
+        _result_cache.move_to_end(key)
+        return chords, midi_path
+
+def store_cached_result(key, chords, midi_path):
+    with _result_cache_lock:
+        _result_cache[key] = (chords, midi_path, time.time()); _result_cache.move_to_end(key)
+        while len(_result_cache) > RESULT_CACHE_MAX: _result_cache.popitem(last=False)
 
 # --- Chord to MIDI notes mapping (Helper Function) ---
 PITCH_CLASSES = {'C': 0, 'C#': 1, 'Db': 1, 'D': 2, 'D#': 3, 'Eb': 3, 'E': 4, 'Fb': 4, 'E#': 5, 'F': 5, 'F#': 6, 'Gb': 6, 'G': 7, 'G#': 8, 'Ab': 8, 'A': 9, 'A#': 10, 'Bb': 10, 'B': 11, 'Cb': 11, 'B#':0}
-def get_notes_for_chord(chord_name, base_octave=4):
-    if not chord_name or chord_name.lower() == 'n' or chord_name.lower() == 'x': return []
+# (third, fifth) semitone intervals above the root
+CHORD_QUALITY_INTERVALS = {'': (4, 7), 'maj': (4, 7), 'm': (3, 7), 'min': (3, 7), 'dim': (3, 6), 'aug': (4, 8)}
+def _quality_intervals(quality):
+    if quality in CHORD_QUALITY_INTERVALS: return CHORD_QUALITY_INTERVALS[quality]
+    # Extended labels (m7, maj7, dim7, sus4, ...) fall back to their underlying triad; check dim/aug/maj before the bare 'm'
+    if 'dim' in quality: return CHORD_QUALITY_INTERVALS['dim']
+    if 'aug' in quality: return CHORD_QUALITY_INTERVALS['aug']
+    if quality.startswith('m') and not quality.startswith('maj'): return CHORD_QUALITY_INTERVALS['m']
+    return CHORD_QUALITY_INTERVALS['']
+
+@functools.lru_cache(maxsize=1024) # Covers labels/octaves outside CHORD_NOTES_LUT; results are immutable tuples
+def _parse_chord_notes(chord_name, base_octave=4):
+    if not chord_name or chord_name.lower() == 'n' or chord_name.lower() == 'x': return ()
     root_str = chord_name[0]; offset = 1
     if len(chord_name) > 1 and (chord_name[1] == '#' or chord_name[1] == 'b'): root_str += chord_name[1]; offset += 1
     quality_str = chord_name[offset:]; root_midi_base = PITCH_CLASSES.get(root_str)
-    if root_midi_base is None: app.logger.warning(f"Unknown root: {root_str} in {chord_name}"); return []
+    if root_midi_base is None: app.logger.warning(f"Unknown root: {root_str} in {chord_name}"); return ()
     root_note = (base_octave + 1) * 12 + root_midi_base
     if root_str in ['A', 'A#', 'Ab', 'B', 'Bb', 'Cb']: root_note -=12
-    third, fifth = root_note + 7, None
-    if 'm' in quality_str.lower() or 'min' in quality_str.lower(): third = root_note + 3
-    elif 'dim' in quality_str.lower(): third, fifth = root_note + 3, root_note + 6
-    elif 'aug' in quality_str.lower(): third, fifth = root_note + 4, root_note + 8
-    else: third = root_note + 4
-    return sorted(list(set(filter(None.__ne__, [root_note, third, fifth]))))
-
-# --- MIDI Generation (Helper Function) ---
+    third_interval, fifth_interval = _quality_intervals(quality_str.lower())
+    return (root_note, root_note + third_interval, root_note + fifth_interval) # Ascending and distinct by construction
+
+# Every label the app can emit (plus common spellings) resolved once, so per-chord lookup is a single dict hit
+CHORD_NOTES_LUT = {root + quality: _parse_chord_notes(root + quality) for root in PITCH_CLASSES for quality in CHORD_QUALITY_INTERVALS}
+def get_notes_for_chord(chord_name, base_octave=4):
+    if base_octave == 4:
+        notes = CHORD_NOTES_LUT.get(chord_name)
+        if notes is not None: return notes
+    return _parse_chord_notes(chord_name, base_octave)
+
+# --- MIDI Generation (Helper Functions) ---
+MIDI_RENDER_VERSION = 2 # Part of the content key; bump whenever chord voicing changes so stale files aren't reused
+# Points the user-facing MIDI name at the shared content-addressed file (copy where symlinks are unsupported)
+def link_midi_to_content(content_path, output_path):
+    if os.path.abspath(content_path) == os.path.abspath(output_path): return
+    tmp_link = f"{output_path}.{uuid.uuid4().hex}.tmp"
+    try: os.symlink(os.path.basename(content_path), tmp_link)
+    except (OSError, NotImplementedError): shutil.copyfile(content_path, tmp_link)
+    os.replace(tmp_link, output_path) # Atomically replaces a previous file/link of the same name
+
+# Notes are produced in strictly increasing time order, so events can be streamed straight into one Type-0 track
+# without pretty_midi's per-note objects and event sort. Tempo is MIDI's default 120 bpm (2 beats per second).
+MIDI_TICKS_PER_BEAT = 480
+def write_midi_with_mido(chord_list, output_path, chord_duration_s):
+    ticks_per_chord = round(chord_duration_s * 2 * MIDI_TICKS_PER_BEAT)
+    mid = mido.MidiFile(type=0, ticks_per_beat=MIDI_TICKS_PER_BEAT); track = mido.MidiTrack(); mid.tracks.append(track)
+    track.append(mido.MetaMessage('set_tempo', tempo=500000, time=0))
+    track.append(mido.Message('program_change', program=0, time=0)) # Acoustic Grand Piano
+    rest_ticks = 0 # Time carried over from unrecognised chords, which leave a rest
+    for chord_name in chord_list:
+        midi_notes = get_notes_for_chord(chord_name)
+        if not midi_notes: rest_ticks += ticks_per_chord; continue
+        for j, note_number in enumerate(midi_notes): track.append(mido.Message('note_on', note=note_number, velocity=100, time=rest_ticks if j == 0 else 0))
+        for j, note_number in enumerate(midi_notes): track.append(mido.Message('note_off', note=note_number, velocity=0, time=ticks_per_chord if j == 0 else 0))
+        rest_ticks = 0
+    track.append(mido.MetaMessage('end_of_track', time=rest_ticks))
+    mid.save(output_path)
+
+def write_midi_with_pretty_midi(chord_list, output_path, chord_duration_s):
+    pm = pretty_midi.PrettyMIDI(); piano_instrument = pretty_midi.Instrument(program=pretty_midi.instrument_name_to_program('Acoustic Grand Piano'))
+    # Chord i spans [i * chord_duration_s, (i + 1) * chord_duration_s); unrecognised chords leave a rest
+    piano_instrument.notes = [pretty_midi.Note(velocity=100, pitch=note_number, start=i * chord_duration_s, end=(i + 1) * chord_duration_s)
+                              for i, chord_name in enumerate(chord_list) for note_number in get_notes_for_chord(chord_name)]
+    pm.instruments.append(piano_instrument); pm.write(output_path)
+
 def create_midi_file_from_chords(chord_list, output_path, chord_duration_s=2.0):
-    if not PRETTY_MIDI_AVAILABLE: return None, "PrettyMIDI not available"
+    if not MIDI_AVAILABLE: return None, "No MIDI library (mido/pretty_midi) available"
     try:
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        pm = pretty_midi.PrettyMIDI(); piano_instrument = pretty_midi.Instrument(program=pretty_midi.instrument_name_to_program('Acoustic Grand Piano'))
-        current_time = 0.0
-        for chord_name in chord_list:
-            midi_notes = get_notes_for_chord(chord_name)
-            if not midi_notes: current_time += chord_duration_s; continue
-            for note_number in midi_notes:
-                piano_instrument.notes.append(pretty_midi.Note(velocity=100, pitch=note_number, start=current_time, end=current_time + chord_duration_s))
-            current_time += chord_duration_s
-        pm.instruments.append(piano_instrument); pm.write(output_path)
-        app.logger.info(f"MIDI created: {output_path}")
+        # MIDI output is fully determined by (chord_list, chord_duration_s): reuse an identical file if one was written before
+        content_key = hashlib.blake2b(f"v{MIDI_RENDER_VERSION}|{chord_duration_s}|{','.join(chord_list)}".encode(), digest_size=16).hexdigest()
+        content_path = os.path.join(os.path.dirname(output_path), f"{content_key}.mid")
+        if os.path.exists(content_path):
+            link_midi_to_content(content_path, output_path)
+            app.logger.info(f"MIDI reused: {content_path}")
+            return output_path, "MIDI file created successfully (reused identical chord progression)"
+        # Write under a temp name in the same directory and rename into place, so concurrent requests/downloads never see a partial file
+        tmp_path = f"{content_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            if MIDO_AVAILABLE: write_midi_with_mido(chord_list, tmp_path, chord_duration_s)
+            else: write_midi_with_pretty_midi(chord_list, tmp_path, chord_duration_s)
+            os.replace(tmp_path, content_path)
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+        app.logger.info(f"MIDI created: {content_path}")
+        link_midi_to_content(content_path, output_path)
         return output_path, "MIDI file created successfully"
     except Exception as e: app.logger.error(f"MIDI creation failed: {e}"); return None, f"MIDI error: {str(e)}"
 
-# --- Librosa Chord Recognition (Helper Function) ---
-def get_librosa_chords_from_audio(audio_path_for_librosa, sr=22050, hop_length=512, frame_duration_s=2.0):
+# --- Chord Templates (built once at import) ---
+PITCH_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+def _build_chord_templates():
+    names, templates = [], []
+    for i in range(12):
+        major_template = np.zeros(12, dtype=np.float32); major_template[[i, (i+4)%12, (i+7)%12]] = 1
+        minor_template = np.zeros(12, dtype=np.float32); minor_template[[i, (i+3)%12, (i+7)%12]] = 1
+        names += [PITCH_NAMES[i], PITCH_NAMES[i] + 'm']; templates += [major_template, minor_template]
+    return names, np.ascontiguousarray(np.stack(templates).T)
+CHORD_NAMES, CHORD_TEMPLATE_MATRIX = _build_chord_templates() # CHORD_TEMPLATE_MATRIX: (12, 24)
+CHORD_TEMPLATE_MATRIX_T = np.ascontiguousarray(CHORD_TEMPLATE_MATRIX.T) # (24, 12), the layout every NumPy scoring path multiplies with
+assert CHORD_TEMPLATE_MATRIX.flags['C_CONTIGUOUS'] and CHORD_TEMPLATE_MATRIX_T.flags['C_CONTIGUOUS'] # No hidden copies inside BLAS
+
+# --- Segment Scoring (Numba kernel, NumPy fallback lives in get_librosa_chords_from_audio) ---
+if NUMBA_AVAILABLE:
+    # Serial on purpose: ~100 segments of 24x12 gain nothing from threads, and a parallel kernel run by the warm-up in the
+    # gunicorn --preload master would leave Numba's (GNU OpenMP) threading layer unusable in the forked workers
+    @numba.njit(fastmath=True, cache=True)
+    def _match_segments(chroma, template_matrix, frames_per_segment, num_segments):
+        n_pitches, n_chords = template_matrix.shape
+        best = np.empty(num_segments, dtype=np.int64)
+        for s in range(num_segments):
+            mean = np.zeros(n_pitches)
+            for f in range(s * frames_per_segment, (s + 1) * frames_per_segment):
+                for p in range(n_pitches): mean[p] += chroma[p, f]
+            # Seed from chord 0 rather than -inf: fastmath implies 'ninf', under which comparing with infinity is undefined
+            best_idx, best_sim = 0, 0.0
+            for p in range(n_pitches): best_sim += mean[p] * template_matrix[p, 0]
+            for c in range(1, n_chords):
+                sim = 0.0
+                for p in range(n_pitches): sim += mean[p] * template_matrix[p, c]
+                if sim > best_sim: best_idx, best_sim = c, sim
+            best[s] = best_idx
+        return best
+
+# --- Streaming Decode (Helper Function) ---
+# Raised when downloaded bytes are not decodable audio: a bad input, not a server fault
+class AudioDecodeError(RuntimeError): pass
+
+# Pipes encoded audio chunks through ffmpeg and returns mono float32 PCM, decoding while the download is in flight
+def decode_audio_stream_with_ffmpeg(chunks, sr=ANALYSIS_SAMPLE_RATE):
+    proc = subprocess.Popen([FFMPEG_PATH, '-loglevel', 'error', '-i', 'pipe:0', '-f', 'f32le', '-ac', '1', '-ar', str(sr), 'pipe:1'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    feed_error = []
+    def feed():
+        try:
+            for chunk in chunks: proc.stdin.write(chunk)
+        except Exception as e: feed_error.append(e) # BrokenPipe if ffmpeg bails out early, or a download error
+        finally:
+            try: proc.stdin.close()
+            except OSError: pass
+    feeder = threading.Thread(target=feed, daemon=True); feeder.start()
+    stderr_chunks = []
+    stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()), daemon=True); stderr_reader.start()
+    raw = proc.stdout.read()
+    feeder.join(); stderr_reader.join(); proc.wait()
+    if feed_error and not isinstance(feed_error[0], BrokenPipeError): raise feed_error[0]
+    if proc.returncode != 0 or not raw:
+        app.logger.warning(f"ffmpeg decode failed: {b''.join(stderr_chunks).decode(errors='replace').strip()}")
+        raise AudioDecodeError("could not decode audio from URL")
+    return np.frombuffer(raw, dtype=np.float32)
+
+# --- Audio Loading (Helper Function) ---
+# libsndfile decodes straight to float32 in one copy; RESAMPLE_TYPE is far cheaper than librosa's default filter
+def load_audio_mono(audio_path, sr=ANALYSIS_SAMPLE_RATE):
+    if SOUNDFILE_AVAILABLE:
+        try:
+            y, orig_sr = soundfile.read(audio_path, dtype='float32', always_2d=False)
+            if y.ndim == 2: y = y.mean(axis=1)
+            if orig_sr != sr: y = librosa.resample(y, orig_sr=orig_sr, target_sr=sr, res_type=RESAMPLE_TYPE)
+            return y, sr
+        except RuntimeError as e: app.logger.info(f"soundfile could not decode {audio_path} ({e}); falling back to librosa.load")
+    return librosa.load(audio_path, sr=sr, mono=True, dtype=np.float32, res_type=RESAMPLE_TYPE)
+
+# --- Chroma Feature Cache (Helper Functions) ---
+# Decoding + resampling dominates analysis time; a 12xN float32 chroma is a fraction of the audio size, so keep it on disk
+def file_sha256(path):
+    # Hash in fixed-size buffers rather than reading the whole audio file into memory
+    with open(path, 'rb') as f:
+        try: return hashlib.file_digest(f, 'sha256').hexdigest() # Python 3.11+, buffered in C
+        except AttributeError: return _stream_sha256(f)
+
+def _stream_sha256(f, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    for chunk in iter(lambda: f.read(chunk_size), b''): h.update(chunk)
+    return h.hexdigest()
+
+def chroma_cache_path(audio_path, sr, hop_length):
+    # Library version and feature parameters are part of the key so upgrades or retuning never serve stale features
+    key = hashlib.sha256(f"{file_sha256(audio_path)}|librosa-{librosa.__version__}|sr{sr}|hop{hop_length}".encode()).hexdigest()
+    return os.path.join(CHROMA_CACHE_DIR, f"{key}.npy")
+
+def url_chroma_cache_path(audio_url, sr=ANALYSIS_SAMPLE_RATE, hop_length=ANALYSIS_HOP_LENGTH):
+    key = hashlib.sha256(f"{audio_url}|librosa-{librosa.__version__}|sr{sr}|hop{hop_length}".encode()).hexdigest()
+    return os.path.join(CHROMA_CACHE_DIR, f"url-{key}.npy")
+
+# Returns None on a miss, an expired entry (max_age_s=None: never expires) or a corrupt entry; expired/corrupt entries are deleted
+def load_cached_chroma(cache_path, max_age_s=None):
+    try: st = os.stat(cache_path)
+    except FileNotFoundError: return None
+    if max_age_s is not None and time.time() - st.st_mtime > max_age_s:
+        _remove_quietly(cache_path); return None # Expired: drop it now rather than leaving it for the size cap
+    try:
+        if st.st_size == 0: raise ValueError("empty cache file") # e.g. left by a crash after os.replace without fsync
+        chroma = np.load(cache_path)
+        if chroma.ndim != 2 or chroma.shape[0] != 12: raise ValueError(f"unexpected chroma shape {chroma.shape}")
+        if max_age_s is None: # Non-expiring entries: bump mtime so size-based pruning evicts least recently used first
+            try: os.utime(cache_path)
+            except OSError: pass
+        return chroma
+    except (OSError, ValueError, EOFError) as e: # EOFError: truncated .npy
+        app.logger.warning(f"Discarding unreadable chroma cache {cache_path}: {e}")
+        _remove_quietly(cache_path); return None
+
+def _remove_quietly(path):
+    try: os.remove(path)
+    except OSError: pass # Already gone (another worker pruned it) or not removable; either way not worth failing a request
+
+# Bounds the on-disk cache: drops expired URL entries and abandoned temp files, then the oldest entries (by mtime)
+# until the directory fits CHROMA_CACHE_MAX_BYTES. Runs at most once per CHROMA_CACHE_PRUNE_INTERVAL_S per process.
+CHROMA_CACHE_MAX_BYTES = 512 * 1024 * 1024
+CHROMA_CACHE_PRUNE_INTERVAL_S = 60
+_last_chroma_prune = 0.0
+_chroma_prune_lock = threading.Lock()
+def prune_chroma_cache():
+    global _last_chroma_prune
+    with _chroma_prune_lock:
+        now = time.time()
+        if now - _last_chroma_prune < CHROMA_CACHE_PRUNE_INTERVAL_S: return
+        _last_chroma_prune = now
+    entries = []
+    with os.scandir(CHROMA_CACHE_DIR) as it:
+        for entry in it:
+            try: st = entry.stat()
+            except OSError: continue
+            age = now - st.st_mtime
+            if (entry.name.startswith('url-') and entry.name.endswith('.npy') and age > URL_CACHE_MAX_AGE_S) or (entry.name.endswith('.tmp') and age > 3600):
+                _remove_quietly(entry.path)
+            elif entry.name.endswith('.npy'): entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CHROMA_CACHE_MAX_BYTES: break
+        _remove_quietly(path); total -= size
+
+def save_cached_chroma(cache_path, chroma):
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f: np.save(f, chroma)
+        os.replace(tmp_path, cache_path) # Concurrent readers never see a partially written array
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+def try_save_cached_chroma(cache_path, chroma):
+    try: save_cached_chroma(cache_path, chroma); prune_chroma_cache()
+    except OSError as e: app.logger.warning(f"Could not cache chroma at {cache_path}: {e}")
+
+# --- Librosa Chord Recognition (Helper Functions) ---
+# also_cache_to: an extra cache entry (e.g. URL-keyed) to store the chroma under
+def get_librosa_chords_from_audio(audio_path_for_librosa, sr=ANALYSIS_SAMPLE_RATE, hop_length=ANALYSIS_HOP_LENGTH, frame_duration_s=2.0, also_cache_to=None):
+    if not LIBROSA_AVAILABLE: return [], "Librosa not available"
+    try:
+        cache_path = chroma_cache_path(audio_path_for_librosa, sr, hop_length)
+        chroma = load_cached_chroma(cache_path)
+        if chroma is not None:
+            app.logger.info(f"Using cached chroma: {cache_path}")
+            sr_loaded = sr
+        else:
+            y, sr_loaded = load_audio_mono(audio_path_for_librosa, sr=sr)
+            chroma = compute_chroma(y, sr_loaded, hop_length=hop_length)
+            try_save_cached_chroma(cache_path, chroma)
+        if also_cache_to: try_save_cached_chroma(also_cache_to, chroma)
+    except Exception as e: app.logger.error(f"Librosa audio loading failed: {e}"); return [], f"Librosa error: {str(e)}"
+    return get_chords_from_chroma(chroma, sr_loaded, hop_length=hop_length, frame_duration_s=frame_duration_s)
+
+def get_librosa_chords_from_signal(y, sr_loaded, hop_length=ANALYSIS_HOP_LENGTH, frame_duration_s=2.0, also_cache_to=None):
     if not LIBROSA_AVAILABLE: return [], "Librosa not available"
+    try: chroma = compute_chroma(y, sr_loaded, hop_length=hop_length)
+    except Exception as e: app.logger.error(f"Librosa chroma extraction failed: {e}"); return [], f"Librosa error: {str(e)}"
+    if also_cache_to: try_save_cached_chroma(also_cache_to, chroma)
+    return get_chords_from_chroma(chroma, sr_loaded, hop_length=hop_length, frame_duration_s=frame_duration_s)
+
+def compute_chroma(y, sr_loaded, hop_length=ANALYSIS_HOP_LENGTH):
+    chroma = librosa.feature.chroma_cqt(y=y, sr=sr_loaded, hop_length=hop_length, n_chroma=12)
+    return chroma.astype(np.float32, copy=False) # Match the float32 templates so scoring never upcasts to float64
+
+def get_chords_from_chroma(chroma, sr_loaded, hop_length=ANALYSIS_HOP_LENGTH, frame_duration_s=2.0):
     try:
-        y, sr_loaded = librosa.load(audio_path_for_librosa, sr=sr)
-        chroma = librosa.feature.chroma_stft(y=y, sr=sr_loaded, hop_length=hop_length)
-        pitches = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-        chord_templates = {}
-        for i in range(12):
-            major_template = np.zeros(12); major_template[i]=1; major_template[(i+4)%12]=1; major_template[(i+7)%12]=1
-            chord_templates[pitches[i]] = major_template
-            minor_template = np.zeros(12); minor_template[i]=1; minor_template[(i+3)%12]=1; minor_template[(i+7)%12]=1
-            chord_templates[pitches[i] + 'm'] = minor_template
-        chord_names = list(chord_templates.keys()); template_matrix = np.array(list(chord_templates.values())).T
+        chroma = np.ascontiguousarray(chroma, dtype=CHORD_TEMPLATE_MATRIX.dtype) # No-op for fresh/cached float32 chroma; avoids an implicit upcast otherwise
         frames_per_segment = int(frame_duration_s * sr_loaded / hop_length); num_segments = chroma.shape[1] // frames_per_segment
-        recognized_chords_list = []
+        if chroma.shape[1] == 0: return ["N"], "No chords recognized"
         if num_segments == 0:
-            if chroma.shape[1] > 0: mean_chroma = np.mean(chroma, axis=1); similarities = np.dot(mean_chroma, template_matrix); recognized_chords_list.append(chord_names[np.argmax(similarities)])
-            else: recognized_chords_list.append("N")
+            mean_chroma = np.mean(chroma, axis=1); similarities = CHORD_TEMPLATE_MATRIX_T @ mean_chroma; chord_indices = np.array([np.argmax(similarities)])
+        elif NUMBA_AVAILABLE:
+            chord_indices = _match_segments(chroma, CHORD_TEMPLATE_MATRIX, frames_per_segment, num_segments)
         else:
-            for i in range(num_segments):
-                segment_chroma = chroma[:, i*frames_per_segment:(i+1)*frames_per_segment]
-                mean_chroma_segment = np.mean(segment_chroma, axis=1); similarities = np.dot(mean_chroma_segment, template_matrix); recognized_chords_list.append(chord_names[np.argmax(similarities)])
-        if not recognized_chords_list: return ["N"], "No chords recognized"
-        simplified_chords = [recognized_chords_list[0]]
-        for chord in recognized_chords_list[1:]:
-            if chord != simplified_chords[-1]: simplified_chords.append(chord)
+            # Average every segment at once, then score all segments against all templates in a single matmul
+            segment_means = chroma[:, :num_segments*frames_per_segment].reshape(12, num_segments, frames_per_segment).mean(axis=2)
+            similarities = CHORD_TEMPLATE_MATRIX_T @ segment_means # (24, num_segments)
+            chord_indices = similarities.argmax(axis=0)
+        # Collapse consecutive repeats on the integer indices, then map only the survivors to names
+        if chord_indices.size == 0: return ["N"], "No chords recognized"
+        changes = np.empty(chord_indices.shape, dtype=bool); changes[0] = True
+        np.not_equal(chord_indices[1:], chord_indices[:-1], out=changes[1:])
+        simplified_chords = [CHORD_NAMES[i] for i in chord_indices[changes].tolist()]
         return simplified_chords, "Librosa processing successful"
     except Exception as e: app.logger.error(f"Librosa chord recognition failed: {e}"); return [], f"Librosa error: {str(e)}"
 
+# --- Analysis Worker Pool ---
+# Request threads (threaded dev server / gunicorn gthread) hand librosa analysis to one pool per process. The cores are
+# split across gunicorn workers (WEB_CONCURRENCY, exported by the Procfile), so all workers together run at most about
+# one analysis per core. Streaming ffmpeg decodes run in their own subprocesses and are not counted against this limit.
+# Threads start lazily, after fork.
+ANALYSIS_WORKERS = max(1, (os.cpu_count() or 1) // max(1, int(os.environ.get('WEB_CONCURRENCY', '1'))))
+ANALYSIS_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix='analysis')
+
+# --- Startup Warm-up ---
+# The first librosa call in a fresh process JIT-compiles its numba kernels; pay that cost at boot, not on the first request
+def warm_up_analysis():
+    try:
+        # A quiet A3 tone rather than silence: all-zero input makes librosa warn that tuning estimation found no pitches
+        t = np.arange(3 * ANALYSIS_SAMPLE_RATE, dtype=np.float32) / ANALYSIS_SAMPLE_RATE
+        get_librosa_chords_from_signal(0.01 * np.sin(2 * np.pi * 220.0 * t), ANALYSIS_SAMPLE_RATE)
+        app.logger.info("Librosa warm-up complete")
+    except Exception as e: app.logger.warning(f"Librosa warm-up failed: {e}")
+
+if LIBROSA_AVAILABLE: warm_up_analysis()
+
 @app.route('/analyze', methods=['POST'])
 def analyze():
-    os.makedirs(TEMP_AUDIO_DIR, exist_ok=True)
-    os.makedirs(TEMP_MIDI_DIR, exist_ok=True)
-    
     audio_path = None
+    decoded_audio = None # Mono PCM at ANALYSIS_SAMPLE_RATE when URL audio was streamed through ffmpeg
+    cached_chroma, url_cache_path = None, None # URL-keyed chroma cache entry (URL inputs only)
+    decode_failure = None # Set when streamed URL content was not decodable audio
     file_id_for_midi = None # Used for naming MIDI file, derived from filename or uuid
+    result_cache_key = None # Set for URL inputs so the finished analysis can be cached
     status_message = "Analysis initiated"
 
     try:
@@ -123,53 +465,88 @@ def analyze():
             status_message = f"Uploaded file '{filename}' processed."
         
         elif audio_url:
+            cached = get_cached_result(audio_url)
+            if cached:
+                app.logger.info(f"Serving cached analysis for URL: {audio_url}")
+                cached_chords, cached_midi_path = cached
+                return jsonify({
+                    "message": "Cached analysis returned for this URL.", "processed_audio_filename": None,
+                    "chords": cached_chords, "recognition_method": "librosa (cached)",
+                    "midi_file_path": cached_midi_path
+                })
             app.logger.info(f"Processing audio from URL: {audio_url}")
-            try:
-                response = requests.get(audio_url, stream=True, timeout=20) # Increased timeout
-                response.raise_for_status()
-                
-                # Attempt to get filename from Content-Disposition or URL
-                url_filename_part = ""
-                cd = response.headers.get('content-disposition')
-                if cd:
-                    fname_match = re.search('filename="?([^"]+)"?', cd)
-                    if fname_match:
-                        url_filename_part = secure_filename(fname_match.group(1))
-                
-                if not url_filename_part: # Fallback to part of URL
-                    url_filename_part = audio_url.split('/')[-1].split('?')[0]
-                    if not url_filename_part or len(url_filename_part) > 64: # Avoid overly long names
-                        url_filename_part = "downloaded_audio"
-
-                _, ext = os.path.splitext(url_filename_part)
-                if not ext or len(ext) > 5 : ext = ".mp3" # Default to .mp3 if no/bad extension
-
-                unique_id = str(uuid.uuid4())
-                unique_filename = f"{unique_id}{ext}"
-                audio_path = os.path.join(TEMP_AUDIO_DIR, secure_filename(unique_filename))
-                
-                with open(audio_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                
-                file_id_for_midi = unique_id # Use UUID for MIDI name to ensure uniqueness
-                status_message = f"Audio downloaded from URL and saved as '{unique_filename}'."
-
-            except requests.exceptions.RequestException as e:
-                app.logger.error(f"Error downloading from URL {audio_url}: {e}")
-                return jsonify({"error": "Failed to download audio from URL.", "details": str(e)}), 400
-            except Exception as e: # Catch other errors during download/saving
-                app.logger.error(f"Error processing URL {audio_url}: {e}", exc_info=True)
-                return jsonify({"error": "An unexpected error occurred processing the URL.", "details": str(e)}), 500
+            result_cache_key = audio_url
+            if LIBROSA_AVAILABLE:
+                url_cache_path = url_chroma_cache_path(audio_url)
+                cached_chroma = load_cached_chroma(url_cache_path, max_age_s=URL_CACHE_MAX_AGE_S)
+            if cached_chroma is not None: # Fresh features on disk for this URL: skip the download entirely
+                file_id_for_midi = str(uuid.uuid4()) # Use UUID for MIDI name to ensure uniqueness
+                status_message = "Audio features reused from the URL cache; download skipped."
+            else:
+                try:
+                    response = HTTP_SESSION.get(audio_url, stream=True, timeout=20) # Increased timeout
+                    response.raise_for_status()
+
+                    # Attempt to get filename from Content-Disposition or URL
+                    url_filename_part = ""
+                    cd = response.headers.get('content-disposition')
+                    if cd:
+                        fname_match = re.search('filename="?([^"]+)"?', cd)
+                        if fname_match:
+                            url_filename_part = secure_filename(fname_match.group(1))
+
+                    if not url_filename_part: # Fallback to part of URL
+                        url_filename_part = audio_url.split('/')[-1].split('?')[0]
+                        if not url_filename_part or len(url_filename_part) > 64: # Avoid overly long names
+                            url_filename_part = "downloaded_audio"
+
+                    content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+                    _, ext = os.path.splitext(url_filename_part)
+                    ext = re.sub(r'[^A-Za-z0-9.]', '', ext) # Only the UUID and this extension form the name, so sanitize it once here
+                    if len(ext) < 2 or len(ext) > 5: # Fall back to the served Content-Type, then .mp3
+                        ext = AUDIO_CONTENT_TYPE_EXTS.get(content_type, ".mp3")
+                    # MP4-family files may keep their index ('moov') after the audio data, which ffmpeg cannot reach on a pipe
+                    needs_seekable_file = ext.lower() in SEEKABLE_ONLY_EXTS or content_type in SEEKABLE_ONLY_CONTENT_TYPES
+
+                    if FFMPEG_PATH and LIBROSA_AVAILABLE and not needs_seekable_file: # Decode straight from the socket, no temp file
+                        file_id_for_midi = str(uuid.uuid4()) # Use UUID for MIDI name to ensure uniqueness
+                        try:
+                            decoded_audio = decode_audio_stream_with_ffmpeg(response.iter_content(chunk_size=1 << 18))
+                            status_message = "Audio streamed from URL and decoded in memory."
+                        except AudioDecodeError as e: # Not audio (e.g. an HTML page): report like any unrecognisable input
+                            decode_failure = str(e)
+                            status_message = "Content downloaded from URL."
+                    else:
+                        unique_id = str(uuid.uuid4())
+                        unique_filename = f"{unique_id}{ext}"
+                        audio_path = os.path.join(TEMP_AUDIO_DIR, unique_filename)
+
+                        response.raw.decode_content = True # Undo any transfer Content-Encoding, as iter_content did
+                        with open(audio_path, 'wb') as f:
+                            shutil.copyfileobj(response.raw, f, length=1 << 20) # Copy loop runs in C with 1 MB reads
+
+                        file_id_for_midi = unique_id # Use UUID for MIDI name to ensure uniqueness
+                        status_message = f"Audio downloaded from URL and saved as '{unique_filename}'."
+
+                except requests.exceptions.RequestException as e:
+                    app.logger.error(f"Error downloading from URL {audio_url}: {e}")
+                    return jsonify({"error": "Failed to download audio from URL.", "details": str(e)}), 400
+                except Exception as e: # Catch other errors during download/saving
+                    app.logger.error(f"Error processing URL {audio_url}: {e}", exc_info=True)
+                    return jsonify({"error": "An unexpected error occurred processing the URL.", "details": str(e)}), 500
         else:
             return jsonify({"error": "No audio file or URL provided."}), 400
 
         # --- Chord Recognition (Librosa only) ---
         recognized_chords, recognition_method = [], "None"
-        if LIBROSA_AVAILABLE:
-            app.logger.info(f"Attempting librosa for {audio_path}")
+        if decode_failure: status_message += f"; Librosa processed but found no valid chords ({decode_failure})"
+        elif LIBROSA_AVAILABLE:
+            app.logger.info(f"Attempting librosa for {audio_path or ('cached URL features' if cached_chroma is not None else 'streamed URL audio')}")
             try:
-                chords_from_librosa, librosa_msg = get_librosa_chords_from_audio(audio_path)
+                if cached_chroma is not None: analysis = ANALYSIS_EXECUTOR.submit(get_chords_from_chroma, cached_chroma, ANALYSIS_SAMPLE_RATE)
+                elif decoded_audio is not None: analysis = ANALYSIS_EXECUTOR.submit(get_librosa_chords_from_signal, decoded_audio, ANALYSIS_SAMPLE_RATE, also_cache_to=url_cache_path)
+                else: analysis = ANALYSIS_EXECUTOR.submit(get_librosa_chords_from_audio, audio_path, also_cache_to=url_cache_path)
+                chords_from_librosa, librosa_msg = analysis.result()
                 if chords_from_librosa and chords_from_librosa != ["N"]:
                     recognized_chords, recognition_method = chords_from_librosa, "librosa"
                     status_message += f"; Chord recognition complete (librosa: {librosa_msg})"
@@ -180,14 +557,17 @@ def analyze():
         # --- MIDI Generation ---
         midi_file_path_for_response = None
         if recognized_chords and file_id_for_midi:
-            if PRETTY_MIDI_AVAILABLE:
+            if MIDI_AVAILABLE:
                 midi_filename = f"{file_id_for_midi}_chords.mid"
                 full_midi_output_path = os.path.join(TEMP_MIDI_DIR, midi_filename)
                 path_or_none, midi_msg = create_midi_file_from_chords(recognized_chords, full_midi_output_path)
                 if path_or_none: midi_file_path_for_response = path_or_none
                 status_message += f"; {midi_msg}"
-            else: status_message += "; MIDI generation skipped: PrettyMIDI not available."
+            else: status_message += "; MIDI generation skipped: no MIDI library (mido/pretty_midi) available."
         elif not recognized_chords: status_message += "; MIDI generation skipped: No chords recognized."
+
+        if result_cache_key and midi_file_path_for_response:
+            store_cached_result(result_cache_key, recognized_chords, midi_file_path_for_response)
             
         return jsonify({
             "message": status_message, "processed_audio_filename": os.path.basename(audio_path) if audio_path else None,
@@ -205,4 +585,4 @@ def analyze():
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    app.run(debug=False, host='0.0.0.0', port=port)
+    app.run(debug=False, use_reloader=False, host='0.0.0.0', port=port)
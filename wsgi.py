@@ -0,0 +1,4 @@
+# WSGI entry point for production servers (see Procfile); `python app.py` remains the local dev server
+from app import app
+
+application = app